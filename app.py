@@ -1,18 +1,53 @@
 from __future__ import annotations
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, g, request, jsonify, render_template
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+import msgspec
+from sqlalchemy import event, text, inspect as sa_inspect
+from sqlalchemy.orm import raiseload
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.pool import QueuePool
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-import secrets, time
+import atexit, hashlib, math, os, random, secrets, threading, time
+
+class MsgspecJSONProvider(DefaultJSONProvider):
+    # C encoder/decoder for jsonify and request.get_json; routes are unchanged
+    def dumps(self, obj, **kwargs):
+        return msgspec.json.encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return msgspec.json.decode(s)
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///minerco.db"
+app.json = MsgspecJSONProvider(app)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("MINERCO_DATABASE_URI", "sqlite:///minerco.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# keep SQLite connections open across requests instead of reconnecting each time
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool, "pool_size": 10, "max_overflow": 20,
+    "connect_args": {"check_same_thread": False, "timeout": 30},
+}
 
 # --- DB ---
 db = SQLAlchemy(app)
 
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets leaderboard/state reads run alongside mining writes
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.close()
+
+with app.app_context():
+    event.listen(db.engine, "connect", _sqlite_pragmas)
+
 class User(db.Model):
+    # covers the leaderboard query, so SQLite never reads the row body
+    __table_args__ = (db.Index("ix_user_silver_username", "silver", "username"),)
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
@@ -24,6 +59,11 @@ class User(db.Model):
     })
     active_powerups = db.Column(db.JSON, default=dict)  # {strength:{mult,until}, luck:{mult,until}}
     pets = db.Column(db.JSON, default=list)             # [{id,name,rarity,effect}]
+    # aggregated pet effects, kept in sync with `pets` by refresh_pet_effects()
+    pet_strength = db.Column(db.Float, default=1.0, server_default="1.0")
+    pet_luck = db.Column(db.Float, default=1.0, server_default="1.0")
+    pet_sell = db.Column(db.Float, default=1.0, server_default="1.0")
+    pet_crit = db.Column(db.Float, default=0.0, server_default="0.0")
     used_codes = db.Column(db.JSON, default=list)
     achievements = db.Column(db.JSON, default=list)
     stats = db.Column(db.JSON, default=lambda: {
@@ -32,12 +72,18 @@ class User(db.Model):
     })
     last_daily = db.Column(db.Integer, default=0)  # epoch ms
     is_admin = db.Column(db.Boolean, default=False)
-    session_token = db.Column(db.String(128), nullable=True)
+    session_token = db.Column(db.LargeBinary(16), nullable=True, unique=True, index=True)  # sent to clients as hex
 
 # --- Game Data (server-authoritative) ---
 ORES = ["coal","copper","bronze","silver","gold","diamond","emerald","rainbow","goldrush"]
 ORE_VALUES = {"coal":1,"copper":2,"bronze":3,"silver":5,"gold":8,"diamond":15,"emerald":30,"rainbow":20,"goldrush":0}
 ORE_REQ = {"coal":"coal","copper":"copper","bronze":"bronze","silver":"silver","gold":"gold","diamond":"diamond","emerald":"emerald","rainbow":"diamond","goldrush":"diamond"}
+ORE_TIER = {o: i for i, o in enumerate(ORES)}
+ORE_YIELD = {o: (o, 1) for o in ORES}  # mined ore -> (ore credited, qty mult)
+ORE_YIELD["goldrush"] = ("gold", 2)
+RAINBOW_ORES = tuple(ORES[:7])
+SELLABLE = tuple((o, ORE_VALUES[o]) for o in ORES if o != "goldrush")
+ORE_REQ_TIER = {o: ORE_TIER[ORE_REQ[o]] for o in ORES}
 PICKAXE_COSTS = {
     "coal": {"coal":10},
     "copper": {"coal":20},
@@ -58,6 +104,9 @@ PET_POOL = [
     {"id":"tortoise","name":"Tortoise","rarity":"common","effect":{"sustain":1}},
 ]
 PET_WEIGHTS = {"common":56, "uncommon":24, "rare":14, "epic":6}
+_RARITY_KEYS = list(PET_WEIGHTS)
+_RARITY_W = [PET_WEIGHTS[k] for k in _RARITY_KEYS]
+_PETS_BY_RARITY = {r: [p for p in PET_POOL if p["rarity"]==r] for r in _RARITY_KEYS}
 CODE_REWARDS = {
     "WELCOME": lambda u: {"silver":200, "message":"Welcome bonus: +200 Silver"},
     "LUCKY":   lambda u: {"powerup":"2x Luck", "message":"+2x Luck (120s)"},
@@ -66,18 +115,57 @@ CODE_REWARDS = {
     "GOLDRUSH":lambda u: {"event":"gold", "message":"Gold Rush for 3 min!"},
 }
 
+# --- Request bodies (decoded + validated in one pass by msgspec) ---
+class LoginReq(msgspec.Struct):
+    username: str = ""
+    password: str = ""
+
+class MineReq(msgspec.Struct):
+    ore: str = "coal"
+
+class PickaxeReq(msgspec.Struct):
+    tier: str|None = None
+
+class PowerupReq(msgspec.Struct):
+    name: str|None = None
+
+class SpinReq(msgspec.Struct):
+    free: bool = False
+
+class CodeReq(msgspec.Struct):
+    code: str|None = None
+
 # --- Helpers ---
+def parse(body_type: type):
+    return msgspec.json.decode(request.get_data(), type=body_type)
+
+PASSWORD_METHOD = "scrypt:32768:8:1"  # OpenSSL-backed hashlib.scrypt
 now_ms = lambda: int(time.time()*1000)
 
+# Loader policy: relationships on User get an explicit selectinload() in
+# DEFAULT_LOAD, never lazy="dynamic". In debug/testing any other lazy load
+# raises instead of silently issuing N+1 queries.
+DEFAULT_LOAD = ()
+
+def user_options() -> tuple:
+    return (*DEFAULT_LOAD, raiseload("*")) if app.debug or app.testing else DEFAULT_LOAD
+
+def user_query():
+    return User.query.options(*user_options())
+
 def auth_user() -> User|None:
-    token = request.headers.get("Authorization")
-    return User.query.filter_by(session_token=token).first() if token else None
+    try:
+        token = bytes.fromhex(request.headers.get("Authorization",""))
+    except ValueError:
+        return None
+    if len(token) != 16: return None
+    return user_query().filter_by(session_token=token).first()
 
 def tier_index(ore: str) -> int:
-    return ORES.index(ore)
+    return ORE_TIER[ore]
 
-def can_mine(user: User, ore: str) -> bool:
-    return tier_index(user.pickaxe) >= tier_index(ORE_REQ[ore])
+def can_mine(pickaxe: str, ore: str) -> bool:
+    return ORE_TIER[pickaxe] >= ORE_REQ_TIER[ore]
 
 def power_mult(user: User, key: str) -> float:
     m = 1.0
@@ -86,36 +174,149 @@ def power_mult(user: User, key: str) -> float:
         m *= float(p.get("mult",1))
     # pet effects
     if key == "strength":
-        for pt in user.pets: m *= float(pt.get("effect",{}).get("strength",1))
+        m *= user.pet_strength
     if key == "luck":
-        for pt in user.pets: m *= float(pt.get("effect",{}).get("luck",1))
+        m *= user.pet_luck
     return m
 
 def sell_mult(user: User) -> float:
-    m = 1.0
-    for pt in user.pets:
-        m *= float(pt.get("effect",{}).get("sell",1))
-    return m
+    return user.pet_sell
 
 def crit_chance(user: User) -> float:
-    chance = float(SWORDS.get(user.sword, 0))
-    for pt in user.pets:
-        chance += float(pt.get("effect",{}).get("crit",0))*100
-    return chance
+    return float(SWORDS.get(user.sword, 0)) + user.pet_crit*100
+
+def refresh_pet_effects(user: User) -> None:
+    effects = [pt.get("effect",{}) for pt in user.pets]
+    user.pet_strength = math.prod(float(e.get("strength",1)) for e in effects)
+    user.pet_luck = math.prod(float(e.get("luck",1)) for e in effects)
+    user.pet_sell = math.prod(float(e.get("sell",1)) for e in effects)
+    user.pet_crit = sum(float(e.get("crit",0)) for e in effects)
 
-def add_ore(user: User, ore: str, qty: int) -> None:
-    inv = dict(user.inventory)
+def bump_stat(user: User, key: str, amount: int) -> None:
+    user.stats[key] = int(user.stats.get(key,0) + amount)
+    flag_modified(user, "stats")
+
+def add_ore(inv: dict, st: dict, ore: str, qty: int) -> None:
+    # callers pass the user's pinned inventory/stats and flag_modified once
     inv[ore] = int(inv.get(ore,0) + qty)
-    user.inventory = inv
     # stats
-    st = dict(user.stats)
     st["oresMined"] = int(st.get("oresMined",0) + qty)
-    tot = dict(st.get("total",{}))
+    tot = st.setdefault("total", {})
     if ore in tot:
         tot[ore] = int(tot.get(ore,0) + qty)
-    st["total"] = tot
-    user.stats = st
 
+# --- Write batching ---
+# /api/mine buffers its deltas here instead of committing every click; they are
+# applied on top of the freshly loaded row and committed in batches.
+# Every write to a user's row happens under user_lock(user.id) on a row re-read
+# after taking the lock, so a flush and a route commit can't overwrite each other.
+COMMIT_INTERVAL = 20    # mine ops per user before a commit
+COMMIT_MAX_AGE = 0.5    # secs before a buffered op is committed
+_pending = {}           # user.id -> {ops, since, ores:{ore:qty}, crits}
+_pending_lock = threading.Lock()
+_user_locks = {}        # user.id -> Lock, guarded by _pending_lock
+
+def user_lock(uid: int) -> threading.Lock:
+    with _pending_lock:
+        return _user_locks.setdefault(uid, threading.Lock())
+
+def take_pending(uid: int, min_age: float = 0.0) -> dict|None:
+    with _pending_lock:
+        p = _pending.get(uid)
+        if p is None or time.monotonic() - p["since"] < min_age:
+            return None
+        return _pending.pop(uid)
+
+def restore_pending(uid: int, p: dict) -> None:
+    # put back a batch whose commit failed, merging with clicks buffered since
+    with _pending_lock:
+        q = _pending.get(uid)
+        if q is None:
+            _pending[uid] = p
+            return
+        q["ops"] += p["ops"]
+        q["since"] = min(q["since"], p["since"])
+        q["crits"] += p["crits"]
+        for ore, qty in p["ores"].items():
+            q["ores"][ore] = q["ores"].get(ore,0) + qty
+
+def apply_pending(user: User, p: dict) -> None:
+    inv, st = user.inventory, user.stats
+    for ore, qty in p["ores"].items():
+        add_ore(inv, st, ore, qty)
+    st["crits"] = int(st.get("crits",0) + p["crits"])
+    flag_modified(user, "inventory")
+    flag_modified(user, "stats")
+
+def commit_pending(user: User, p: dict) -> None:
+    # caller holds user_lock(user.id) and loaded `user` after taking it
+    apply_pending(user, p)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        restore_pending(user.id, p)
+        raise
+
+def flush_user(user: User) -> None:
+    # caller holds user_lock(user.id)
+    db.session.refresh(user)
+    p = take_pending(user.id)
+    if p: commit_pending(user, p)
+
+def flush_pending(min_age: float = 0.0) -> None:
+    with _pending_lock:
+        uids = list(_pending)
+    for uid in uids:
+        with user_lock(uid):
+            p = take_pending(uid, min_age)
+            if not p: continue
+            user = db.session.get(User, uid, options=user_options(), populate_existing=True)
+            if user: commit_pending(user, p)
+
+def locked_user() -> User|None:
+    """auth_user() for routes that write the user or report its full state.
+
+    Holds the user's write lock until the request ends and commits their
+    buffered mining first, so the route works on the current row.
+    """
+    user = auth_user()
+    if not user: return None
+    lock = user_lock(user.id)
+    lock.acquire()
+    g.user_lock = lock
+    flush_user(user)
+    return user
+
+@app.teardown_request
+def release_user_lock(_exc):
+    lock = g.pop("user_lock", None)
+    if lock: lock.release()
+
+def flush_loop() -> None:
+    # commits buffers of users who stopped clicking; active clickers commit from
+    # their own /api/mine call, so a buffer waits at most ~1.5x COMMIT_MAX_AGE
+    while True:
+        time.sleep(COMMIT_MAX_AGE / 2)
+        try:
+            with app.app_context():
+                flush_pending(min_age=COMMIT_MAX_AGE)
+        except Exception:
+            app.logger.exception("flushing buffered mining failed")
+
+_flusher_pid = None
+
+def ensure_flusher() -> None:
+    # started lazily (under _pending_lock) so every forked worker runs its own
+    global _flusher_pid
+    if _flusher_pid != os.getpid():
+        _flusher_pid = os.getpid()
+        threading.Thread(target=flush_loop, name="flush-pending", daemon=True).start()
+
+@atexit.register
+def flush_on_exit():
+    with app.app_context():
+        flush_pending()
 
 def serialize(user: User) -> dict:
     return {
@@ -133,163 +334,183 @@ def serialize(user: User) -> dict:
         "is_admin": user.is_admin,
     }
 
+# serialize() key -> User attribute, for keys that differ
+_CAMEL = {"activePowerups":"active_powerups", "usedCodes":"used_codes", "lastDaily":"last_daily"}
+
+def delta(user: User, *keys: str) -> dict:
+    # write routes return only what they changed; /api/state is the full refresh
+    return {k: getattr(user, _CAMEL.get(k,k)) for k in keys}
+
 # --- Routes ---
+@app.errorhandler(msgspec.DecodeError)
+def bad_body(e):
+    return jsonify({"error": f"Bad request: {e}"}), 400
+
+# the UI is static between deploys: render it once and let clients revalidate
+with app.app_context():
+    _INDEX_HTML = render_template("index.html")
+_INDEX_ETAG = hashlib.md5(_INDEX_HTML.encode()).hexdigest()
+
 @app.route("/")
 def home():
-    return render_template("index.html")
+    resp = Response(_INDEX_HTML, mimetype="text/html")
+    resp.set_etag(_INDEX_ETAG)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 60
+    return resp.make_conditional(request)
 
 @app.route("/api/login", methods=["POST"])
 def login():
-    data = request.get_json(force=True)
-    username, password = data.get("username",""), data.get("password","")
+    req = parse(LoginReq)
+    username, password = req.username, req.password
     if not username or not password:
         return jsonify({"error":"Username and password required"}), 400
-    user = User.query.filter_by(username=username).first()
+    user = user_query().filter_by(username=username).first()
     if user is None:
-        user = User(username=username, password_hash=generate_password_hash(password))
+        user = User(username=username, password_hash=generate_password_hash(password, method=PASSWORD_METHOD))
         db.session.add(user)
         db.session.commit()
     else:
         if not check_password_hash(user.password_hash, password):
             return jsonify({"error":"Invalid password"}), 401
-    user.session_token = secrets.token_hex(16)
+        if not user.password_hash.startswith("scrypt:"):
+            # upgrade legacy pbkdf2 hashes while we have the plaintext
+            user.password_hash = generate_password_hash(password, method=PASSWORD_METHOD)
+    user.session_token = secrets.token_bytes(16)
     db.session.commit()
-    return jsonify({"token": user.session_token, **serialize(user)})
+    return jsonify({"token": user.session_token.hex(), **serialize(user)})
 
 @app.route("/api/state", methods=["GET"])
 def state():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    return jsonify(serialize(user))
+    resp = jsonify(serialize(user))
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 @app.route("/api/mine", methods=["POST"])
 def api_mine():
     user = auth_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    ore = request.json.get("ore","coal")
+    ore = parse(MineReq).ore
     if ore not in ORES:
         return jsonify({"error":"Unknown ore"}), 400
-    if not can_mine(user, ore):
+    if not can_mine(user.pickaxe, ore):
         return jsonify({"error":"Locked ore for your pickaxe"}), 403
     # yield
     qty = max(1, int(1 * power_mult(user, "strength")))
-    # crit
-    import random
-    if random.random()*100 < crit_chance(user):
-        qty *= 2
-        st = dict(user.stats); st["crits"] = int(st.get("crits",0)+1); user.stats = st
+    # crit doubles the yield
+    crit = int(random.random()*100 < crit_chance(user))
+    qty <<= crit
     # special ores
+    ore, mult = ORE_YIELD[ore]
+    qty *= mult
     if ore == "rainbow":
-        bonus = ORES[:7][random.randint(0,6)]
-        add_ore(user, bonus, qty)
-    elif ore == "goldrush":
-        add_ore(user, "gold", qty*2)
-    else:
-        add_ore(user, ore, qty)
-    db.session.commit()
-    return jsonify(serialize(user))
+        ore = random.choice(RAINBOW_ORES)
+    # buffer the click; only commit every COMMIT_INTERVAL ops / COMMIT_MAX_AGE secs
+    with _pending_lock:
+        ensure_flusher()
+        p = _pending.setdefault(user.id, {"ops":0, "since":time.monotonic(), "ores":{}, "crits":0})
+        p["ops"] += 1
+        p["crits"] += crit
+        p["ores"][ore] = p["ores"].get(ore,0) + qty
+        due = p["ops"] >= COMMIT_INTERVAL or time.monotonic() - p["since"] >= COMMIT_MAX_AGE
+        if not due:
+            apply_pending(user, p)  # response only; rolled back at teardown
+    if due:
+        with user_lock(user.id):
+            flush_user(user)
+    return jsonify(delta(user, "inventory", "stats"))
 
 @app.route("/api/sell_all", methods=["POST"])
 def sell_all():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    inv = dict(user.inventory)
-    gain = 0
-    for ore, val in ORE_VALUES.items():
-        if ore == "goldrush":
-            continue
-        qty = int(inv.get(ore,0))
-        if qty>0:
-            gain += qty * val
-            inv[ore] = 0
+    inv = user.inventory
+    gain = sum(inv.get(o,0) * v for o, v in SELLABLE)
+    for o, _ in SELLABLE:
+        if inv.get(o): inv[o] = 0
     mult = sell_mult(user)
     gain = int(gain * mult)
-    user.inventory = inv
+    flag_modified(user, "inventory")
     user.silver += gain
-    st = dict(user.stats); st["silverEarned"] = int(st.get("silverEarned",0) + gain); user.stats = st
+    bump_stat(user, "silverEarned", gain)
     db.session.commit()
-    return jsonify({"silver": user.silver, "gain": gain, **serialize(user)})
+    return jsonify({"gain": gain, **delta(user, "silver", "inventory", "stats")})
 
 @app.route("/api/shop/pickaxe", methods=["POST"])
 def shop_pickaxe():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    tier = request.json.get("tier")
+    tier = parse(PickaxeReq).tier
     if tier not in PICKAXE_COSTS:
         return jsonify({"error":"Unknown pickaxe"}), 400
     # already owned or higher
     if tier_index(user.pickaxe) >= tier_index(tier):
-        return jsonify({"message":"Already owned", **serialize(user)})
+        return jsonify({"message":"Already owned", **delta(user, "pickaxe")})
     cost = PICKAXE_COSTS[tier]
-    inv = dict(user.inventory)
+    inv = user.inventory
     # check cost
     for ore, need in cost.items():
         if int(inv.get(ore,0)) < need:
             return jsonify({"error":"Not enough resources"}), 400
     for ore, need in cost.items():
         inv[ore] = int(inv.get(ore,0)) - need
-    user.inventory = inv
+    flag_modified(user, "inventory")
     user.pickaxe = tier
     db.session.commit()
-    return jsonify({"message":"Purchased", **serialize(user)})
+    return jsonify({"message":"Purchased", **delta(user, "pickaxe", "inventory")})
 
 @app.route("/api/shop/powerup", methods=["POST"])
 def shop_powerup():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    name = request.json.get("name")
+    name = parse(PowerupReq).name
     if name not in POWERUPS:
         return jsonify({"error":"Unknown powerup"}), 400
     price = 50 if name == "2x Strength" else 75
     if user.silver < price:
         return jsonify({"error":"Need more silver"}), 400
     user.silver -= price
-    st = dict(user.stats); st["silverSpent"] = int(st.get("silverSpent",0) + price); user.stats = st
+    bump_stat(user, "silverSpent", price)
     eff = POWERUPS[name]
     until = now_ms() + eff["secs"]*1000
-    ap = dict(user.active_powerups)
-    ap[eff["key"]] = {"mult": eff["mult"], "until": until}
-    user.active_powerups = ap
+    user.active_powerups[eff["key"]] = {"mult": eff["mult"], "until": until}
+    flag_modified(user, "active_powerups")
     db.session.commit()
-    return jsonify({"message":"Activated", **serialize(user)})
+    return jsonify({"message":"Activated", **delta(user, "silver", "stats", "activePowerups")})
 
 @app.route("/api/pets/spin", methods=["POST"])
 def pets_spin():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
     cost = 150
-    free = bool(request.json.get("free", False))
+    free = parse(SpinReq).free
     if user.silver < cost and not free:
         return jsonify({"error":"Need 150 silver"}), 400
     if not free:
         user.silver -= cost
-        st = dict(user.stats); st["silverSpent"] = int(st.get("silverSpent",0) + cost); user.stats = st
+        bump_stat(user, "silverSpent", cost)
     # roll rarity
-    import random
-    bag = ([("common",)*1]*PET_WEIGHTS["common"] +
-           [("uncommon",)*1]*PET_WEIGHTS["uncommon"] +
-           [("rare",)*1]*PET_WEIGHTS["rare"] +
-           [("epic",)*1]*PET_WEIGHTS["epic"])  # simplified weights bag
-    flat = [k for sub in bag for k in sub]
-    rarity = random.choice(flat)
-    candidates = [p for p in PET_POOL if p["rarity"]==rarity]
-    pet = random.choice(candidates)
-    owned = list(user.pets)
+    rarity = random.choices(_RARITY_KEYS, weights=_RARITY_W, k=1)[0]
+    pet = random.choice(_PETS_BY_RARITY[rarity])
+    owned = user.pets
     if any(p.get("id")==pet["id"] for p in owned):
         user.silver += 50
         msg = f"Duplicate {pet['name']}. Refunded 50 silver."
     else:
         owned.append(pet)
-        user.pets = owned
+        flag_modified(user, "pets")
+        refresh_pet_effects(user)
         msg = f"New pet: {pet['name']}!"
     db.session.commit()
-    return jsonify({"message": msg, **serialize(user)})
+    return jsonify({"message": msg, **delta(user, "silver", "stats", "pets")})
 
 @app.route("/api/codes/redeem", methods=["POST"])
 def codes_redeem():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    raw = (request.json.get("code") or "").upper().strip()
+    raw = (parse(CodeReq).code or "").upper().strip()
     if not raw:
         return jsonify({"error":"Code required"}), 400
     if raw in (user.used_codes or []):
@@ -298,31 +519,32 @@ def codes_redeem():
     if not fn:
         return jsonify({"error":"Invalid code"}), 400
     reward = fn(user)
-    if reward.get("silver"): user.silver += int(reward["silver"]) ; st = dict(user.stats); st["silverEarned"] = int(st.get("silverEarned",0)+int(reward["silver"])) ; user.stats = st
+    if reward.get("silver"): user.silver += int(reward["silver"]) ; bump_stat(user, "silverEarned", int(reward["silver"]))
     if reward.get("item"):
-        inv = dict(user.inventory)
+        inv = user.inventory
         for k,v in reward["item"].items(): inv[k] = int(inv.get(k,0))+int(v)
-        user.inventory = inv
+        flag_modified(user, "inventory")
     if reward.get("powerup"):
         name = reward["powerup"]
         eff = POWERUPS[name]
-        ap = dict(user.active_powerups)
-        ap[eff["key"]] = {"mult": eff["mult"], "until": now_ms()+eff["secs"]*1000}
-        user.active_powerups = ap
+        user.active_powerups[eff["key"]] = {"mult": eff["mult"], "until": now_ms()+eff["secs"]*1000}
+        flag_modified(user, "active_powerups")
     if reward.get("freepet"): pass  # front can call /api/pets/spin with {free:true}
     # event ignored server-side for simplicity
-    user.used_codes = (user.used_codes or []) + [raw]
+    if user.used_codes is None: user.used_codes = []
+    user.used_codes.append(raw); flag_modified(user, "used_codes")
     db.session.commit()
-    return jsonify({"message": reward.get("message","OK"), **serialize(user)})
+    return jsonify({"message": reward.get("message","OK"),
+                    **delta(user, "silver", "stats", "inventory", "activePowerups", "usedCodes")})
 
 @app.route("/api/leaderboard", methods=["GET"])
 def leaderboard():
-    top = User.query.order_by(User.silver.desc()).limit(10).all()
-    return jsonify([{"username": u.username, "silver": u.silver} for u in top])
+    top = db.session.query(User.username, User.silver).order_by(User.silver.desc()).limit(10).all()
+    return jsonify([{"username": u, "silver": s} for u, s in top])
 
 @app.route("/api/daily/claim", methods=["POST"])
 def daily_claim():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
     day_ms = 24*60*60*1000
     if user.last_daily and (now_ms() - int(user.last_daily) < day_ms):
@@ -330,21 +552,21 @@ def daily_claim():
     user.last_daily = now_ms()
     gain = 200
     user.silver += gain
-    st = dict(user.stats); st["silverEarned"] = int(st.get("silverEarned",0)+gain); user.stats = st
+    bump_stat(user, "silverEarned", gain)
     # short random powerup 60s
     eff = POWERUPS["2x Strength" if (secrets.randbelow(2)==0) else "2x Luck"]
-    ap = dict(user.active_powerups); ap[eff["key"]] = {"mult": eff["mult"], "until": now_ms()+60*1000}; user.active_powerups = ap
+    user.active_powerups[eff["key"]] = {"mult": eff["mult"], "until": now_ms()+60*1000}; flag_modified(user, "active_powerups")
     db.session.commit()
-    return jsonify({"message":"Daily claimed", **serialize(user)})
+    return jsonify({"message":"Daily claimed", **delta(user, "silver", "stats", "activePowerups", "lastDaily")})
 
 # --- Admin ---
 ADMIN_CODE = "danielis67"
 
 @app.route("/api/admin/login", methods=["POST"])
 def admin_login():
-    user = auth_user()
+    user = locked_user()
     if not user: return jsonify({"error":"Unauthorized"}), 401
-    code = request.json.get("code","")
+    code = parse(CodeReq).code
     if code == ADMIN_CODE:
         user.is_admin = True
         db.session.commit()
@@ -353,7 +575,7 @@ def admin_login():
 
 @app.route("/api/admin/money", methods=["POST"])
 def admin_money():
-    user = auth_user()
+    user = locked_user()
     if not user or not user.is_admin: return jsonify({"error":"Forbidden"}), 403
     user.silver += 999_999
     db.session.commit()
@@ -361,18 +583,54 @@ def admin_money():
 
 @app.route("/api/admin/powerups", methods=["POST"])
 def admin_powerups():
-    user = auth_user()
+    user = locked_user()
     if not user or not user.is_admin: return jsonify({"error":"Forbidden"}), 403
     until = now_ms()+10*60*1000
-    ap = dict(user.active_powerups)
+    ap = user.active_powerups
     ap["strength"] = {"mult":2, "until": until}
     ap["luck"] = {"mult":2, "until": until}
-    user.active_powerups = ap
+    flag_modified(user, "active_powerups")
     db.session.commit()
     return jsonify({"message":"All powerups for 10 minutes", **serialize(user)})
 
+# --- Migrations ---
+# create_all() only builds missing tables; columns and indexes added to User
+# since the first release are added to existing databases here
+ADDED_COLUMNS = {
+    "pet_strength": "FLOAT DEFAULT 1.0",
+    "pet_luck": "FLOAT DEFAULT 1.0",
+    "pet_sell": "FLOAT DEFAULT 1.0",
+    "pet_crit": "FLOAT DEFAULT 0.0",
+}
+
+# same names create_all() uses, so fresh databases skip these
+ADDED_INDEXES = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_session_token ON "user" (session_token)',
+    'CREATE INDEX IF NOT EXISTS ix_user_silver_username ON "user" (silver, username)',
+)
+
+def migrate() -> None:
+    have = {c["name"] for c in sa_inspect(db.engine).get_columns("user")}
+    missing = [name for name in ADDED_COLUMNS if name not in have]
+    for name in missing:
+        db.session.execute(text(f'ALTER TABLE "user" ADD COLUMN {name} {ADDED_COLUMNS[name]}'))
+    if missing:
+        # pets owned before the aggregate columns existed
+        for user in user_query().all():
+            refresh_pet_effects(user)
+    for stmt in ADDED_INDEXES:
+        db.session.execute(text(stmt))
+    db.session.commit()
+
 # --- Run ---
+# production: gunicorn app:app (settings in gunicorn.conf.py, which pins a single
+# worker process because the /api/mine buffer is per-process)
+# tables are created here (not under __main__) so gunicorn workers get them too;
+# the pool is disposed so forked workers don't inherit the master's connections
+with app.app_context():
+    db.create_all()
+    migrate()
+    db.engine.dispose()
+
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
-    app.run(host="0.0.0.0", port=1000, debug=True)
+    app.run(host="0.0.0.0", port=1000, debug=bool(os.getenv("FLASK_DEV")))
@@ -0,0 +1,12 @@
+# Picked up automatically by `gunicorn app:app` from this directory.
+# /api/mine buffers clicks in process memory (see app.py), so every request for
+# a user must reach the one process holding their buffer: scale with threads.
+bind = "0.0.0.0:1000"
+worker_class = "gthread"
+workers = 1
+threads = 16
+preload_app = True
+
+def on_starting(server):
+    if server.cfg.workers != 1:
+        raise SystemExit("MinerCo buffers mining per process: run a single worker and scale with --threads")
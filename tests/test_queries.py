@@ -0,0 +1,156 @@
+import contextlib, json, os, sys, tempfile, threading, time
+
+os.environ["MINERCO_DATABASE_URI"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import event, inspect, text
+
+import app as m
+
+# schema as shipped before the pet_* columns and the extra indexes
+BASELINE_USER_TABLE = """CREATE TABLE user (
+    id INTEGER NOT NULL, username VARCHAR(64) NOT NULL, password_hash VARCHAR(256) NOT NULL,
+    silver INTEGER, pickaxe VARCHAR(32), sword VARCHAR(32), inventory JSON, active_powerups JSON,
+    pets JSON, used_codes JSON, achievements JSON, stats JSON, last_daily INTEGER,
+    is_admin BOOLEAN, session_token VARCHAR(128), PRIMARY KEY (id), UNIQUE (username))"""
+
+
+@pytest.fixture
+def client(monkeypatch):
+    m.app.testing = True
+    # keep buffers in memory unless a test flushes them explicitly
+    monkeypatch.setattr(m, "COMMIT_MAX_AGE", 60)
+    with m.app.app_context():
+        m.db.drop_all()
+        m.db.create_all()
+    m._pending.clear()
+    return m.app.test_client()
+
+
+def login(client, username="miner"):
+    data = client.post("/api/login", json={"username": username, "password": "pw"}).get_json()
+    return {"Authorization": data["token"]}
+
+
+def user_id(username="miner"):
+    with m.app.app_context():
+        return m.User.query.filter_by(username=username).one().id
+
+
+def committed(uid):
+    # read the row outside any request session, i.e. what is actually on disk
+    with m.app.app_context(), m.db.engine.connect() as conn:
+        inv, silver = conn.execute(text('SELECT inventory, silver FROM "user" WHERE id=:id'), {"id": uid}).one()
+    return json.loads(inv), silver
+
+
+def mine(client, headers, n):
+    for _ in range(n):
+        resp = client.post("/api/mine", json={"ore": "coal"}, headers=headers)
+        assert resp.status_code == 200
+    return resp.get_json()
+
+
+@contextlib.contextmanager
+def count_queries():
+    queries = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+    with m.app.app_context():
+        engine = m.db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_state_query_count(client):
+    headers = login(client)
+    with count_queries() as queries:
+        resp = client.get("/api/state", headers=headers)
+    assert resp.status_code == 200
+    assert len(queries) <= 2, queries
+
+
+def test_mine_commits_every_interval(client):
+    headers = login(client)
+    uid = user_id()
+    data = mine(client, headers, m.COMMIT_INTERVAL - 1)
+    assert data["inventory"]["coal"] == 10 + m.COMMIT_INTERVAL - 1
+    assert committed(uid)[0]["coal"] == 10
+    mine(client, headers, 1)
+    assert committed(uid)[0]["coal"] == 10 + m.COMMIT_INTERVAL
+    assert uid not in m._pending
+
+
+def test_write_route_commits_own_buffer_first(client):
+    headers = login(client)
+    uid = user_id()
+    mine(client, headers, 3)
+    data = client.post("/api/sell_all", json={}, headers=headers).get_json()
+    assert data["gain"] == 13
+    assert committed(uid) == ({**committed(uid)[0], "coal": 0}, 13)
+    assert uid not in m._pending
+
+
+def test_read_routes_leave_buffers_alone(client):
+    headers = login(client)
+    uid = user_id()
+    mine(client, headers, 3)
+    client.get("/api/leaderboard")
+    client.get("/")
+    assert m._pending[uid]["ores"] == {"coal": 3}
+    assert committed(uid)[0]["coal"] == 10
+
+
+def test_failed_flush_keeps_buffer(client, monkeypatch):
+    headers = login(client)
+    uid = user_id()
+    mine(client, headers, 3)
+    def boom():
+        raise RuntimeError("database is locked")
+    with m.app.app_context():
+        monkeypatch.setattr(m.db.session, "commit", boom)
+        with pytest.raises(RuntimeError):
+            m.flush_pending()
+        monkeypatch.undo()
+    assert m._pending[uid]["ores"] == {"coal": 3}
+    with m.app.app_context():
+        m.flush_pending()
+    assert committed(uid)[0]["coal"] == 13
+
+
+def test_flush_waits_for_user_lock(client):
+    headers = login(client)
+    uid = user_id()
+    mine(client, headers, 3)
+    def flush():
+        with m.app.app_context():
+            m.flush_pending()
+    lock = m.user_lock(uid)
+    with lock:
+        t = threading.Thread(target=flush)
+        t.start()
+        time.sleep(0.2)
+        assert t.is_alive()
+        assert committed(uid)[0]["coal"] == 10
+    t.join()
+    assert committed(uid)[0]["coal"] == 13
+
+
+def test_migrate_upgrades_baseline_schema(client):
+    pets = [p for p in m.PET_POOL if p["id"] in ("mole", "cat")]
+    with m.app.app_context():
+        m.db.drop_all()
+        m.db.session.execute(text(BASELINE_USER_TABLE))
+        m.db.session.execute(text('INSERT INTO "user" (username, password_hash, silver, pets) VALUES (:u, :h, 0, :p)'),
+                             {"u": "old", "h": "x", "p": json.dumps(pets)})
+        m.db.session.commit()
+        m.migrate()
+        insp = inspect(m.db.engine)
+        assert set(m.ADDED_COLUMNS) <= {c["name"] for c in insp.get_columns("user")}
+        assert {"ix_user_session_token", "ix_user_silver_username"} <= {i["name"] for i in insp.get_indexes("user")}
+        user = m.User.query.filter_by(username="old").one()
+        assert (user.pet_strength, user.pet_luck, user.pet_sell, user.pet_crit) == (1.25, 1.5, 1.0, 0.0)